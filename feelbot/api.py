@@ -1,17 +1,17 @@
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
 from fastapi import FastAPI
 
 from .client import Client
-from .models import Lesson
+from .models import Lesson, SeatPreference
 
 
 app = FastAPI()
 
 
 @app.get('/find', response_model=Lesson)
-async def find_lesson(
+def find_lesson(
     studio: str,
     schedule: datetime,
     polling: bool = False,
@@ -24,34 +24,38 @@ async def find_lesson(
 
 
 @app.post('/reserve', response_model=Lesson)
-async def reserve_lesson(
+def reserve_lesson(
     studio: str,
     schedule: datetime,
     polling: bool = False,
-    sleep: int = 30
+    sleep: int = 30,
+    preference: Optional[SeatPreference] = None
 ):
     with Client() as client:
         success, lesson = client.reserve_lesson(
-            studio, schedule, relocate=False, polling=polling, sleep=int(sleep))
+            studio, schedule, relocate=False, polling=polling,
+            sleep=int(sleep), preference=preference)
 
     return lesson
 
 
 @app.post('/relocate', response_model=Lesson)
-async def relocate_lesson(
+def relocate_lesson(
     studio: str,
     schedule: datetime,
     polling: bool = False,
-    sleep: int = 30
+    sleep: int = 30,
+    preference: Optional[SeatPreference] = None
 ):
     with Client() as client:
         success, lesson = client.reserve_lesson(
-            studio, schedule, relocate=True, polling=polling, sleep=int(sleep))
+            studio, schedule, relocate=True, polling=polling,
+            sleep=int(sleep), preference=preference)
     return lesson
 
 
 @app.post('/scrape', response_model=List[Lesson])
-async def scrape_lessons(
+def scrape_lessons(
     studios: List[str],
     start_date: datetime,
 ):
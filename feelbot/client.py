@@ -1,10 +1,11 @@
+import json
 import os
 import random
 import time
 
 from datetime import datetime
 from datetime import timedelta
-from typing import Optional, Union, Tuple, List
+from typing import Any, Callable, Dict, Optional, Union, Tuple, List
 
 from dotenv import load_dotenv
 from loguru import logger
@@ -12,19 +13,47 @@ from pydantic import SecretStr
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException
 from selenium.common.exceptions import NoSuchElementException
-from selenium.webdriver.common.alert import Alert
+from selenium.webdriver.common.by import By
 from selenium.webdriver.remote.webdriver import WebDriver
 from selenium.webdriver.remote.webelement import WebElement
+from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support.select import Select
 
-from .models import Lesson, Reservation
-from .utils import convert_datetime
+from .coordination import Coordinator, LeaseTimeoutError
+from .models import Lesson, Reservation, Seat, SeatPreference
+from .utils import convert_datetime, group_positions
+from .watchdog import Watchdog
 
 
 MYPAGE_URL = 'https://www.feelcycle.com/feelcycle_reserve/mypage.php'
 RESERVE_URL = 'https://www.feelcycle.com/feelcycle_reserve/reserve.php'
 
+POLL_FREQUENCY = 0.1
+WAIT_TIMEOUT = 10
+
+# name of the wait -> seconds the most recent wait took
+wait_durations: Dict[str, float] = {}
+
+# reads the whole seat map in a single round trip
+SEAT_MAP_SCRIPT = '''
+return Array.prototype.map.call(
+    document.getElementsByClassName('number'),
+    function (element) {
+        var link = element.getElementsByTagName('a')[0] || null;
+        var rect = element.getBoundingClientRect();
+        return {
+            text: element.textContent,
+            link: link,
+            linkClass: link ? link.className : null,
+            top: rect.top,
+            left: rect.left,
+            height: rect.height,
+            width: rect.width
+        };
+    });
+'''
+
 
 class NotLoginError(Exception):
     pass
@@ -42,6 +71,22 @@ class LessonNotFoundError(Exception):
     pass
 
 
+def wait_until(
+    driver: WebDriver,
+    condition: Callable[[WebDriver], Any],
+    name: str,
+    timeout: float = WAIT_TIMEOUT
+) -> Any:
+    start = time.monotonic()
+    try:
+        return WebDriverWait(driver, timeout, poll_frequency=POLL_FREQUENCY) \
+            .until(condition)
+    finally:
+        elapsed = time.monotonic() - start
+        wait_durations[name] = elapsed
+        logger.debug(f'wait {name}: {elapsed:.3f}s')
+
+
 def is_login(driver: WebDriver) -> bool:
     driver.get(MYPAGE_URL)
     try:
@@ -60,12 +105,22 @@ def login(
     if is_login(driver):
         return True
     else:
-        WebDriverWait(driver, timeout)
+        wait_until(
+            driver,
+            EC.presence_of_element_located((By.NAME, 'login_pass')),
+            'login_form', timeout)
         driver.find_element_by_name('login_id').send_keys(username)
         driver.find_element_by_name('login_pass').send_keys(password)
         driver.find_element_by_class_name('submit_b') \
               .find_element_by_tag_name('input').click()
-        return is_login(driver)
+        try:
+            wait_until(
+                driver,
+                EC.presence_of_element_located((By.CLASS_NAME, 'log_in_id')),
+                'login_marker', timeout)
+            return True
+        except TimeoutException:
+            return is_login(driver)
 
 
 def select_studio(
@@ -144,11 +199,50 @@ def find_lesson(
     return return_values
 
 
+def _seat_map_rendered() -> Callable[[WebDriver], bool]:
+    # the seat map is complete once the number of seats stops changing
+    # between two polls
+    counts = []
+
+    def _rendered(driver: WebDriver) -> bool:
+        counts.append(len(driver.find_elements_by_class_name('number')))
+        return len(counts) > 1 and counts[-1] > 0 and \
+            counts[-1] == counts[-2]
+
+    return _rendered
+
+
+def read_seat_map(
+    driver: WebDriver
+) -> Tuple[List[Seat], Dict[int, WebElement]]:
+    snapshot = driver.execute_script(SEAT_MAP_SCRIPT)
+    if not snapshot:
+        return [], {}
+    height = min(item['height'] for item in snapshot) or 2
+    width = min(item['width'] for item in snapshot) or 2
+    rows = group_positions([item['top'] for item in snapshot], height / 2)
+    columns = group_positions([item['left'] for item in snapshot], width / 2)
+    seats, links = [], {}
+    for index, item in enumerate(snapshot):
+        digits = ''.join(c for c in item['text'] if c.isdigit())
+        number = int(digits) if digits else index + 1
+        seat = Seat(number=number,
+                    available=item['linkClass'] in ('thickbox', ''),
+                    row=rows[index],
+                    column=columns[index])
+        seats.append(seat)
+        if item['link'] is not None:
+            links[number] = item['link']
+    return seats, links
+
+
 def reserve_lesson(
     driver: WebDriver,
     studio: str,
     schedule: datetime,
-    relocate: bool = False
+    relocate: bool = False,
+    preference: Optional[SeatPreference] = None,
+    timeout: float = WAIT_TIMEOUT
 ) -> Tuple[bool, Optional[Lesson]]:
     lesson, lesson_element =\
         find_lesson(driver, studio, schedule, return_element=True)
@@ -163,22 +257,72 @@ def reserve_lesson(
         if lesson.status == Reservation.RESERVED:
             return True, lesson
 
+    seats, links = _open_seat_map(driver, lesson_element, timeout)
+    lesson.seats = seats
+    seat = (preference or SeatPreference()).choose(seats)
+    if seat is None:
+        return False, lesson
+
+    links[seat.number].click()
+    if relocate:
+        wait_until(driver, EC.alert_is_present(),
+                   'relocate_alert', timeout).accept()
+    confirm_link = wait_until(driver, _confirm_link, 'confirm_dialog', timeout)
+    confirm_link.click()
+    try:
+        wait_until(driver, EC.staleness_of(confirm_link),
+                   'reserve_done', timeout)
+    except TimeoutException:
+        logger.info('confirm page did not change, check the lesson status')
+
+    # the seat may have been taken since the snapshot, so report what the
+    # site shows rather than what we asked for
+    result, result_element = \
+        find_lesson(driver, studio, schedule, return_element=True)
+    if result is None:
+        return False, lesson
+    result.seats = seats
+    if result.status != Reservation.RESERVED:
+        return False, result
+    if relocate:
+        # the lesson was reserved before the move as well, so check on the
+        # seat map that the chosen seat was taken and a seat was given back
+        after, _ = _open_seat_map(driver, result_element, timeout)
+        result.seats = after
+        if not _relocated(seats, after, seat.number):
+            return False, result
+    else:
+        seat.available = False
+    result.seat = seat.number
+    return True, result
+
+
+def _open_seat_map(
+    driver: WebDriver,
+    lesson_element: WebElement,
+    timeout: float
+) -> Tuple[List[Seat], Dict[int, WebElement]]:
     lesson_element.click()
-    success = False
-    for seat_element in driver.find_elements_by_class_name('number')[::-1]:
-        seat_link = seat_element.find_element_by_tag_name('a')
-        if seat_link.get_attribute('class') not in ('thickbox', ''):
-            continue
-        seat_link.click()
-        if relocate:
-            time.sleep(1)
-            Alert(driver).accept()
-        driver.find_elements_by_class_name('coment')[1] \
-              .find_elements_by_tag_name('a')[1] \
-              .click()
-        success = True
-        break
-    return success, lesson
+    wait_until(driver, _seat_map_rendered(), 'seat_dialog', timeout)
+    return read_seat_map(driver)
+
+
+def _relocated(before: List[Seat], after: List[Seat], number: int) -> bool:
+    available = {seat.number: seat.available for seat in after}
+    taken = available.get(number) is False
+    released = any(not seat.available and available.get(seat.number)
+                   for seat in before)
+    return taken and released
+
+
+def _confirm_link(driver: WebDriver) -> Union[WebElement, bool]:
+    comments = driver.find_elements_by_class_name('coment')
+    if len(comments) < 2:
+        return False
+    links = comments[1].find_elements_by_tag_name('a')
+    if len(links) < 2 or not links[1].is_displayed():
+        return False
+    return links[1]
 
 
 def scrape_studio_lessons(
@@ -254,28 +398,111 @@ def get_driver() -> WebDriver:
 class Client(object):
 
     MAX_RETRY = 10
+    WATCH_TTL = 180
+    CACHE_MAX_AGE = 10
+    SESSION_MAX_AGE = 3600
+    # longer than restoring a session plus a full login with page loads
+    LOGIN_TTL = 300
+    HEARTBEAT_INTERVAL = 30
+    COOKIE_KEYS = ('name', 'value', 'path', 'domain',
+                   'secure', 'httpOnly', 'expiry')
 
     def __init__(self):
-        self.driver = get_driver()
-        self.count = 0
         load_dotenv(verbose=True)
+        self.count = 0
+        self.coordinator = Coordinator()
+        self.owner = Coordinator.new_owner()
+        self.watchdog = Watchdog(self.coordinator)
+        # Chrome is started on first use, so a client that only follows
+        # another worker's watch never takes a driver slot
+        self.slot: Optional[str] = None
+        self.driver: Optional[WebDriver] = None
+        # (name, ttl) of the polling watch this client owns
+        self.watch: Optional[Tuple[str, float]] = None
 
     def __enter__(self):
         return self
 
     def __exit__(self, ex_type, ex_value, trace):
-        self.driver.quit()
+        self._stop_driver()
 
-    def _refresh_driver(self):
-        if self.count > self.MAX_RETRY:
-            self.count = 0
-            self.driver.quit()
-            time.sleep(5)
+    def _start_driver(self) -> None:
+        if self.driver is not None:
+            return
+        self.slot = self.watchdog.acquire(self.owner,
+                                          on_wait=self._renew_watch)
+        try:
             self.driver = get_driver()
+        except Exception:
+            self.watchdog.release(self.slot, self.owner)
+            self.slot = None
+            raise
+        finally:
+            self.watchdog.started(self.owner)
+        self.count = 0
+        self.watchdog.record(self.slot, self.owner, self.driver)
+
+    def _stop_driver(self) -> None:
+        if self.driver is None:
+            return
+        try:
+            self.driver.quit()
+        finally:
+            self.driver = None
+            self.watchdog.release(self.slot, self.owner)
+            self.slot = None
+
+    def _heartbeat(self) -> Optional[int]:
+        # keeps the driver slot and records the driver's memory, or stops
+        # the driver if another client took the slot over
+        if self.driver is None:
+            return None
+        if not self.watchdog.renew(self.slot, self.owner):
+            logger.info(f'{self.slot} was taken over, stop the driver')
+            self._stop_driver()
+            return None
+        return self.watchdog.record(self.slot, self.owner, self.driver)
+
+    def _own_watch(self, name: str, ttl: float) -> bool:
+        self.watch = (name, ttl)
+        return self._renew_watch()
+
+    def _renew_watch(self) -> bool:
+        # False once another worker has taken the watch over
+        if self.watch is None:
+            return False
+        name, ttl = self.watch
+        if self.coordinator.acquire(name, self.owner, ttl):
+            return True
+        self.watch = None
+        return False
+
+    def _release_watch(self) -> None:
+        if self.watch is not None:
+            self.coordinator.release(self.watch[0], self.owner)
+            self.watch = None
+
+    def _pause(self, sleep: int) -> None:
+        remaining = random.randint(int(sleep*0.5), int(sleep*1.5))
+        while remaining > 0:
+            interval = min(remaining, self.HEARTBEAT_INTERVAL)
+            time.sleep(interval)
+            remaining -= interval
+            self._heartbeat()
+            self._renew_watch()
+
+    def _refresh_driver(self):
+        rss = self._heartbeat()
+        if self.driver is not None and \
+           (self.count > self.MAX_RETRY or self.watchdog.should_recycle(rss)):
+            self._stop_driver()
+        if self.driver is None:
+            self._start_driver()
         else:
             self.count += 1
 
     def is_login(self) -> bool:
+        self._start_driver()
         return is_login(self.driver)
 
     def login(self) -> None:
@@ -283,10 +510,51 @@ class Client(object):
             return
         username = os.environ.get('FEELCYCLE_USERNAME')
         password = os.environ.get('FEELCYCLE_PASSWORD')
-        success = login(self.driver, username, password)
+        session = f'session:{username}'
+        with self.coordinator.lease(session, self.owner,
+                                    ttl=self.LOGIN_TTL,
+                                    timeout=self.LOGIN_TTL,
+                                    on_wait=self._renew_watch):
+            # every worker shares one site session per account, so only
+            # log in when no other worker holds a valid one
+            if self._restore_session(session):
+                return
+            success = login(self.driver, username, password)
+            if success:
+                self.coordinator.set(
+                    session, json.dumps(self.driver.get_cookies()))
         if not success:
             LoginError()
 
+    def _restore_session(self, session: str) -> bool:
+        cookies = self.coordinator.get(session, self.SESSION_MAX_AGE)
+        if cookies is None:
+            return False
+        self.driver.delete_all_cookies()
+        for cookie in json.loads(cookies):
+            self.driver.add_cookie({key: value
+                                    for key, value in cookie.items()
+                                    if key in self.COOKIE_KEYS})
+        return is_login(self.driver)
+
+    @staticmethod
+    def _lesson_key(studio: str, schedule: datetime) -> str:
+        return f'lesson:{studio}:{schedule.isoformat()}'
+
+    def _cache_lesson(self, lesson: Lesson) -> None:
+        self.coordinator.set(self._lesson_key(lesson.studio, lesson.schedule),
+                             lesson.json())
+
+    def _cached_lesson(
+        self,
+        studio: str,
+        schedule: datetime,
+        max_age: float
+    ) -> Optional[Lesson]:
+        value = self.coordinator.get(self._lesson_key(studio, schedule),
+                                     max_age)
+        return Lesson.parse_raw(value) if value is not None else None
+
     def select_studio(self, studio: str) -> None:
         self.login()
         select_studio(self.driver, studio)
@@ -303,22 +571,45 @@ class Client(object):
             lesson = find_lesson(self.driver, studio, schedule, False)
             if lesson is None:
                 raise LessonNotFoundError()
+            self._cache_lesson(lesson)
             return lesson
 
         if polling:
-            while True:
-                self._refresh_driver()
-                try:
-                    lesson = _find()
-                except TimeoutException:
-                    logger.info('timeout error, retry')
-                    continue
-                if lesson.status == Reservation.FULL:
-                    time.sleep(random.randint(int(sleep*0.5), int(sleep*1.5)))
-                else:
-                    return lesson
+            watch = f'find:{studio}:{schedule.isoformat()}'
+            ttl = max(sleep * 3, self.WATCH_TTL)
+            try:
+                while True:
+                    # a worker that polled this lesson may have just found it
+                    lesson = self._cached_lesson(
+                        studio, schedule, max_age=sleep * 2)
+                    if lesson is not None and \
+                       lesson.status != Reservation.FULL:
+                        return lesson
+                    if not self._own_watch(watch, ttl):
+                        # another worker polls this lesson, follow its results
+                        self._stop_driver()
+                        self._pause(sleep)
+                        continue
+                    try:
+                        self._refresh_driver()
+                        # starting Chrome may have blocked, make sure the
+                        # watch is still ours before polling the site
+                        if not self._renew_watch():
+                            continue
+                        lesson = _find()
+                    except (TimeoutException, LeaseTimeoutError):
+                        logger.info('timeout error, retry')
+                        continue
+                    if lesson.status == Reservation.FULL:
+                        self._pause(sleep)
+                    else:
+                        return lesson
+            finally:
+                self._release_watch()
         else:
-            return _find()
+            lesson = self._cached_lesson(
+                studio, schedule, max_age=self.CACHE_MAX_AGE)
+            return lesson if lesson is not None else _find()
 
     def reserve_lesson(
         self,
@@ -327,34 +618,60 @@ class Client(object):
         relocate: bool = False,
         polling: bool = False,
         sleep: int = 30,
+        preference: Optional[SeatPreference] = None,
     ) -> Tuple[bool, Optional[Lesson]]:
         def _reserve():
             self.login()
             success, lesson = reserve_lesson(
-                self.driver, studio, schedule, relocate=relocate)
+                self.driver, studio, schedule, relocate=relocate,
+                preference=preference)
             if lesson is None:
                 raise LessonNotFoundError()
-            if success:
-                lesson = find_lesson(self.driver, studio, schedule, False)
-                if lesson is None:
-                    raise LessonNotFoundError()
+            self._cache_lesson(lesson)
             return success, lesson
 
         if polling:
-            while True:
-                self._refresh_driver()
-                try:
-                    success, lesson = _reserve()
-                except TimeoutException:
-                    logger.info('timeout error, retry')
-                    continue
-                if lesson is None:
-                    return False, None
-                elif (relocate is False and lesson.status == Reservation.FULL) or \
-                     (relocate is True and success is False):
-                    time.sleep(random.randint(int(sleep*0.5), int(sleep*1.5)))
-                else:
-                    return success, lesson
+            action = 'relocate' if relocate else 'reserve'
+            watch = f'{action}:{studio}:{schedule.isoformat()}'
+            ttl = max(sleep * 3, self.WATCH_TTL)
+            try:
+                while True:
+                    # a worker that held this watch may have just reserved
+                    cached = self._cached_lesson(
+                        studio, schedule, max_age=sleep * 2)
+                    if relocate is False and cached is not None and \
+                       cached.status == Reservation.RESERVED:
+                        return True, cached
+                    # wait while another worker works on this reservation
+                    # or a fresh shared result says the lesson is still full
+                    if not self._own_watch(watch, ttl):
+                        self._stop_driver()
+                        self._pause(sleep)
+                        continue
+                    cached = self._cached_lesson(
+                        studio, schedule, max_age=sleep * 0.5)
+                    if relocate is False and cached is not None and \
+                       cached.status == Reservation.FULL:
+                        self._pause(sleep)
+                        continue
+                    try:
+                        self._refresh_driver()
+                        if not self._renew_watch():
+                            continue
+                        success, lesson = _reserve()
+                    except (TimeoutException, LeaseTimeoutError):
+                        logger.info('timeout error, retry')
+                        continue
+                    if lesson is None:
+                        return False, None
+                    elif (relocate is False and
+                          lesson.status == Reservation.FULL) or \
+                         (relocate is True and success is False):
+                        self._pause(sleep)
+                    else:
+                        return success, lesson
+            finally:
+                self._release_watch()
         else:
             return _reserve()
 
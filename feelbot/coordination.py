@@ -0,0 +1,130 @@
+import os
+import sqlite3
+import time
+import uuid
+
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+from loguru import logger
+
+
+DEFAULT_PATH = os.path.join(
+    os.path.expanduser('~'), '.feelbot', 'coordination.sqlite3')
+
+
+class LeaseTimeoutError(Exception):
+    pass
+
+
+# Leases and cached values shared by every worker process in the container.
+# A lease expires after its ttl unless the owner renews it, so another
+# worker can take over from one that died.
+class Coordinator(object):
+
+    POLL_FREQUENCY = 0.1
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.environ.get('FEELBOT_COORDINATION_DB',
+                                           DEFAULT_PATH)
+        self._create_private(self.path)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS leases ('
+                         'name TEXT PRIMARY KEY, '
+                         'owner TEXT NOT NULL, '
+                         'expires REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                         'key TEXT PRIMARY KEY, '
+                         'value TEXT NOT NULL, '
+                         'updated REAL NOT NULL)')
+
+    @staticmethod
+    def _create_private(path: str) -> None:
+        # the database holds the shared login cookies, so only the user
+        # running the workers may read it
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o700)
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+
+    @staticmethod
+    def new_owner() -> str:
+        return f'{os.getpid()}-{uuid.uuid4().hex}'
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        # takes a free or expired lease, or renews our own
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET '
+                'owner = excluded.owner, expires = excluded.expires '
+                'WHERE leases.owner = excluded.owner OR leases.expires < ?',
+                (name, owner, now + ttl, now))
+            return cursor.rowcount == 1
+
+    def release(self, name: str, owner: str) -> None:
+        with self._connect() as conn:
+            conn.execute('DELETE FROM leases WHERE name = ? AND owner = ?',
+                         (name, owner))
+
+    @contextmanager
+    def lease(
+        self,
+        name: str,
+        owner: str,
+        ttl: float = 60,
+        timeout: float = 120,
+        on_wait: Optional[Callable[[], object]] = None
+    ) -> Iterator[None]:
+        start = time.monotonic()
+        while not self.acquire(name, owner, ttl):
+            if time.monotonic() - start > timeout:
+                raise LeaseTimeoutError(name)
+            if on_wait is not None:
+                on_wait()
+            time.sleep(self.POLL_FREQUENCY)
+        logger.debug(f'lease {name}: waited '
+                     f'{time.monotonic() - start:.3f}s')
+        try:
+            yield
+        finally:
+            self.release(name, owner)
+
+    def get(self, key: str, max_age: float) -> Optional[str]:
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT value FROM cache WHERE key = ? AND updated >= ?',
+                (key, time.time() - max_age)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO cache (key, value, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET '
+                'value = excluded.value, updated = excluded.updated',
+                (key, value, time.time()))
+
+    def delete(self, key: str) -> None:
+        with self._connect() as conn:
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def items(self, prefix: str, max_age: float) -> Dict[str, str]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT key, value FROM cache '
+                'WHERE substr(key, 1, ?) = ? AND updated >= ?',
+                (len(prefix), prefix, time.time() - max_age)).fetchall()
+        return {key[len(prefix):]: value for key, value in rows}
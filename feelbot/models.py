@@ -1,6 +1,6 @@
 from enum import Enum
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -12,12 +12,45 @@ class Reservation(Enum):
     PAST = 'PAST'
 
 
+class Seat(BaseModel):
+    number: int
+    available: bool
+    row: int
+    column: int
+
+
+class SeatPreference(BaseModel):
+    favorites: List[int] = []
+    front_row: bool = False
+    avoid: List[int] = []
+
+    def choose(self, seats: List[Seat]) -> Optional[Seat]:
+        candidates = [(index, seat) for index, seat in enumerate(seats)
+                      if seat.available and seat.number not in self.avoid]
+        if not candidates:
+            return None
+
+        def rank(candidate):
+            index, seat = candidate
+            if seat.number in self.favorites:
+                favorite = self.favorites.index(seat.number)
+            else:
+                favorite = len(self.favorites)
+            row = seat.row if self.front_row else 0
+            # without any preference, prefer the seat listed last on the map
+            return favorite, row, -index
+
+        return min(candidates, key=rank)[1]
+
+
 class Lesson(BaseModel):
     schedule: datetime
     studio: str
     program: str
     instructor: str
     status: Reservation
+    seat: Optional[int] = None
+    seats: Optional[List[Seat]] = None
 
     def text(self, prefix='', suffix=''):
         msg = ''
@@ -25,6 +58,8 @@ class Lesson(BaseModel):
         msg += f'lesson: {self.schedule.strftime("%m/%d %H:%M")} ' \
                f'{self.program} ({self.instructor}) @{self.studio}\n' \
                f'status: {self.status.value}'
+        if self.seat is not None:
+            msg += f'\nseat: {self.seat}'
         msg += suffix
         return msg
 
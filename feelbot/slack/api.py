@@ -4,20 +4,22 @@ from datetime import datetime
 from threading import Thread
 from typing import List
 
-import requests
 from dotenv import load_dotenv
 from fastapi import Depends, FastAPI, Request
 from loguru import logger
 
+from .dispatcher import Dispatcher
 from .verification import verify_signature, verify_timestamp
 from .models import SlackCommand
-from ..client import Client
-from ..models import lessons2csv
+from .. import watchdog
+from ..client import Client, wait_durations
+from ..models import SeatPreference, lessons2csv
 from ..utils import convert_datetime
 
 
 app = FastAPI()
 load_dotenv(verbose=True)
+dispatcher = Dispatcher()
 
 
 @app.post(
@@ -50,16 +52,16 @@ def _background_find_lesson(
     polling: bool = False,
     sleep: int = 30
 ):
-    with Client() as client:
-        try:
+    try:
+        with Client() as client:
             lesson = client.find_lesson(
                 studio, schedule, polling=polling, sleep=sleep)
-            incoming_webhook(user_id,
-                             lesson.text(prefix='lesson information\n'))
-        except Exception as e:
-            logger.exception(f'{e}')
-            logger.exception(user_id,
-                             f'something wrong: {e.__class__.__name__}\n{e}')
+        incoming_webhook(user_id,
+                         lesson.text(prefix='lesson information\n'))
+    except Exception as e:
+        logger.exception(f'{e}')
+        incoming_webhook(user_id,
+                         f'something wrong: {e.__class__.__name__}\n{e}')
 
 
 @app.post(
@@ -118,17 +120,26 @@ def _background_reserve_lesson(
     polling: bool = False,
     sleep: int = 30
 ):
-    with Client() as client:
-        try:
+    try:
+        with Client() as client:
             success, lesson = client.reserve_lesson(
                 studio, schedule, relocate=relocate,
-                polling=polling, sleep=sleep)
-            pref = 'reservation success!\n' if success else 'reservation failed\n'
-            incoming_webhook(user_id, lesson.text(prefix=pref))
-        except Exception as e:
-            logger.exception(f'{e}')
-            incoming_webhook(user_id,
-                             f'something wrong: {e.__class__.__name__}\n{e}')
+                polling=polling, sleep=sleep,
+                preference=_seat_preference(user_id))
+        pref = 'reservation success!\n' if success else 'reservation failed\n'
+        incoming_webhook(user_id, lesson.text(prefix=pref))
+    except Exception as e:
+        logger.exception(f'{e}')
+        incoming_webhook(user_id,
+                         f'something wrong: {e.__class__.__name__}\n{e}')
+
+
+def _seat_preference(user_id: str) -> SeatPreference:
+    # FEELBOT_SEAT_PREFERENCES='{"<slack user id>": {"favorites": [12, 13],
+    #                            "front_row": true, "avoid": [1]}}'
+    preferences = json.loads(
+        os.environ.get('FEELBOT_SEAT_PREFERENCES') or '{}')
+    return SeatPreference(**preferences.get(user_id, {}))
 
 
 def _parse_parameters(parameters):
@@ -176,32 +187,31 @@ def _background_scrape_lessons(
     lessons: List[str],
     start_date: datetime
 ):
-    with Client() as client:
-        try:
+    try:
+        with Client() as client:
             lessons = client.scrape_lessons(lessons, start_date)
-            logger.info('Scraping finished. Try uploading a snippet.')
-            content = lessons2csv(lessons)
-            title = 'lessons.csv'
-            file_upload(user_id, title, content)
-        except Exception as e:
-            logger.exception(f'{e}')
-            logger.exception(user_id,
-                             f'something wrong: {e.__class__.__name__}\n{e}')
+        logger.info('Scraping finished. Try uploading a snippet.')
+        content = lessons2csv(lessons)
+        title = 'lessons.csv'
+        file_upload(user_id, title, content)
+    except Exception as e:
+        logger.exception(f'{e}')
+        incoming_webhook(user_id,
+                         f'something wrong: {e.__class__.__name__}\n{e}')
+
+
+@app.get('/metrics')
+def metrics():
+    return {
+        'slack': dispatcher.metrics(),
+        'drivers': watchdog.metrics(),
+        'waits': dict(wait_durations),
+    }
 
 
 def incoming_webhook(user_id, message):
-    message = f'<@{user_id}> ' + message
-    logger.info('webhook response\n' + message)
-    requests.post(
-        os.environ.get('FEELCYCLE_BOT_INCOMING_WEBHOOK'),
-        data=json.dumps({'text': message}).encode('utf-8'))
+    dispatcher.send_message(user_id, message)
 
 
 def file_upload(user_id, title, content):
-    payload = {
-        'token': os.environ.get('SLACK_OAUTH_ACCESS_TOKEN'),
-        'channels': os.environ.get('SLACK_FEELBOT_CHANNEL_ID'),
-        'title': title,
-        'content': content
-    }
-    requests.post("https://slack.com/api/files.upload", data=payload)
+    dispatcher.upload_file(title, content)
@@ -0,0 +1,247 @@
+import json
+import os
+import queue
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+
+SLACK_API_URL = 'https://slack.com/api'
+
+
+def _retry_after(value: Optional[str], default: float) -> float:
+    # Retry-After is either delay seconds or an HTTP-date
+    if value is None:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+# Delivers Slack notifications in the background, so scraping threads never
+# wait on Slack. Messages to the same user within `window` seconds are
+# merged into one webhook post, and up to `pool_size` posts are in flight
+# at once, so a rate limited user does not hold up the others.
+class Dispatcher(object):
+
+    def __init__(
+        self,
+        webhook_url: Optional[str] = None,
+        api_url: str = SLACK_API_URL,
+        token: Optional[str] = None,
+        channel: Optional[str] = None,
+        window: float = 2.0,
+        maxsize: int = 1000,
+        timeout: float = 10.0,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        pool_size: int = 4,
+        max_wait: Optional[float] = None,
+    ):
+        self.webhook_url = webhook_url or \
+            os.environ.get('FEELCYCLE_BOT_INCOMING_WEBHOOK')
+        self.api_url = api_url
+        self.token = token or os.environ.get('SLACK_OAUTH_ACCESS_TOKEN')
+        self.channel = channel or os.environ.get('SLACK_FEELBOT_CHANNEL_ID')
+        self.window = window
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        # longest delay a pool thread sleeps before a retry
+        self.max_wait = max_wait if max_wait is not None \
+            else timeout * max_retries
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        # user id -> (deadline, first enqueue time, messages)
+        self.pending: Dict[str, Tuple[float, float, List[str]]] = {}
+        # users with a post in flight, their next batch waits for it
+        self.in_flight: Set[str] = set()
+        self.latencies: deque = deque(maxlen=100)
+        self.counters = {'delivered': 0, 'dropped': 0,
+                         'failed': 0, 'retried': 0}
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self._lock = threading.Lock()
+        self._counters_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _put(self, item: tuple) -> None:
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self._count('dropped')
+            logger.warning('slack dispatcher queue is full, drop notification')
+
+    def send_message(self, user_id: str, message: str) -> None:
+        self._put(('message', time.monotonic(), user_id, message))
+
+    def upload_file(self, title: str, content: str) -> None:
+        self._put(('file', time.monotonic(), title, content))
+
+    def flush(self, timeout: float = 30.0) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.queue.unfinished_tasks == 0 and not self.pending:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def _count(self, name: str) -> None:
+        with self._counters_lock:
+            self.counters[name] += 1
+
+    def metrics(self) -> dict:
+        latencies = list(self.latencies)
+        with self._counters_lock:
+            counters = dict(self.counters)
+        return {
+            'queue_depth': self.queue.qsize(),
+            'pending_users': len(self.pending),
+            **counters,
+            'latency_last': latencies[-1] if latencies else None,
+            'latency_avg':
+                sum(latencies) / len(latencies) if latencies else None,
+        }
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self._step()
+            except Exception as e:
+                logger.exception(f'slack dispatcher error: {e}')
+
+    def _step(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            ready = [user_id for user_id, (deadline, _, _)
+                     in self.pending.items()
+                     if deadline <= now and user_id not in self.in_flight]
+            self.in_flight.update(ready)
+        for user_id in ready:
+            _, enqueued, messages = self.pending.pop(user_id)
+            self.executor.submit(
+                self._deliver_message, user_id, messages, enqueued)
+
+        timeout = None
+        if self.pending:
+            deadline = min(deadline for deadline, _, _
+                           in self.pending.values())
+            # a user whose previous post is still in flight is rechecked
+            # shortly instead of spinning on a deadline in the past
+            timeout = max(deadline - time.monotonic(), 0.05)
+        try:
+            item = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+
+        try:
+            if item[0] == 'message':
+                _, enqueued, user_id, message = item
+                if user_id in self.pending:
+                    self.pending[user_id][2].append(message)
+                else:
+                    self.pending[user_id] = \
+                        (enqueued + self.window, enqueued, [message])
+            else:
+                _, enqueued, title, content = item
+                self.executor.submit(
+                    self._deliver_file, title, content, enqueued)
+        except Exception:
+            # the item never reached a delivery, so nothing else marks it
+            self._count('failed')
+            self.queue.task_done()
+            raise
+
+    def _deliver_message(
+        self,
+        user_id: str,
+        messages: List[str],
+        enqueued: float
+    ) -> None:
+        try:
+            message = f'<@{user_id}> ' + '\n\n'.join(messages)
+            logger.info('webhook response\n' + message)
+            self._post(self.webhook_url, enqueued,
+                       data=json.dumps({'text': message}).encode('utf-8'))
+        except Exception as e:
+            self._count('failed')
+            logger.exception(f'slack notification failed: {e}')
+        finally:
+            with self._lock:
+                self.in_flight.discard(user_id)
+            for _ in messages:
+                self.queue.task_done()
+
+    def _deliver_file(self, title: str, content: str, enqueued: float) -> None:
+        payload = {
+            'token': self.token,
+            'channels': self.channel,
+            'title': title,
+            'content': content
+        }
+        try:
+            self._post(f'{self.api_url}/files.upload', enqueued, data=payload)
+        except Exception as e:
+            self._count('failed')
+            logger.exception(f'slack file upload failed: {e}')
+        finally:
+            self.queue.task_done()
+
+    def _post(self, url: str, enqueued: float, **kwargs) -> None:
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(url, timeout=self.timeout,
+                                             **kwargs)
+                if response.status_code == 429:
+                    wait = _retry_after(response.headers.get('Retry-After'),
+                                        self.backoff * 2 ** attempt)
+                elif response.status_code >= 500:
+                    wait = self.backoff * 2 ** attempt
+                elif response.status_code >= 400:
+                    break
+                else:
+                    self._count('delivered')
+                    self.latencies.append(time.monotonic() - enqueued)
+                    return
+                if wait > self.max_wait:
+                    logger.info(f'slack asked to wait {wait}s, give up')
+                    break
+                logger.info(f'slack returned {response.status_code}, '
+                            f'retry in {wait}s')
+            except requests.RequestException as e:
+                wait = self.backoff * 2 ** attempt
+                logger.info(f'slack request failed: {e}, retry in {wait}s')
+            if attempt < self.max_retries:
+                self._count('retried')
+                time.sleep(wait)
+        self._count('failed')
+        logger.error(f'slack notification to {url} failed')
@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import List
 
 
 def convert_datetime(
@@ -21,3 +22,20 @@ def convert_datetime(
     else:
         hour, minute = 0, 0
     return datetime(year, month, day, hour=hour, minute=minute)
+
+
+def group_positions(
+    positions: List[float],
+    tolerance: float
+) -> List[int]:
+    # seats in the same visual row (column) may be offset by a few pixels,
+    # so positions within the tolerance of the first position of a group
+    # share its index
+    groups = {}
+    index, anchor = -1, None
+    for position in sorted(set(positions)):
+        if anchor is None or position - anchor > tolerance:
+            index += 1
+            anchor = position
+        groups[position] = index
+    return [groups[position] for position in positions]
@@ -0,0 +1,138 @@
+import json
+import os
+import time
+
+from typing import Callable, Optional
+
+import psutil
+from loguru import logger
+from selenium.webdriver.remote.webdriver import WebDriver
+
+from .coordination import Coordinator, LeaseTimeoutError
+
+
+MB = 1024 * 1024
+RSS_PREFIX = 'driver-rss:'
+
+
+def _process_tree_rss(pid: int) -> int:
+    try:
+        process = psutil.Process(pid)
+        processes = [process] + process.children(recursive=True)
+    except psutil.Error:
+        return 0
+    rss = 0
+    for process in processes:
+        try:
+            rss += process.memory_info().rss
+        except psutil.Error:
+            continue
+    return rss
+
+
+def driver_rss(driver: WebDriver) -> int:
+    process = driver.service.process
+    if process is None:
+        return 0
+    return _process_tree_rss(process.pid)
+
+
+def chrome_rss() -> int:
+    rss = 0
+    for process in psutil.process_iter(['name', 'memory_info']):
+        name = process.info['name'] or ''
+        memory = process.info['memory_info']
+        if 'chrom' in name and memory is not None:
+            rss += memory.rss
+    return rss
+
+
+def metrics(coordinator: Optional[Coordinator] = None) -> dict:
+    coordinator = coordinator or Coordinator()
+    drivers = {}
+    for owner, value in coordinator.items(RSS_PREFIX,
+                                          Watchdog.SLOT_TTL).items():
+        driver = json.loads(value)
+        drivers[owner] = {'slot': driver['slot'],
+                          'rss_mb': driver['rss'] // MB}
+    return {
+        'chrome_rss_mb': chrome_rss() // MB,
+        'drivers': drivers,
+    }
+
+
+# Keeps the number of Chrome drivers and their memory within a budget
+# shared by every worker process in the container. A driver slot is a
+# lease in the coordinator, so new clients queue until a slot is free and
+# the Chrome processes of the container leave room for one more driver.
+# Only one client at a time checks the memory and starts Chrome, so
+# concurrent starts cannot all pass the same check.
+class Watchdog(object):
+
+    POLL_FREQUENCY = 1.0
+    SLOT_TTL = 600
+    START_LEASE = 'driver-start'
+    START_TTL = 60
+
+    def __init__(self, coordinator: Optional[Coordinator] = None):
+        self.coordinator = coordinator or Coordinator()
+        self.max_drivers = int(os.environ.get('FEELBOT_MAX_DRIVERS', 4))
+        self.max_total_rss = \
+            int(os.environ.get('FEELBOT_MAX_CHROME_RSS_MB', 2048)) * MB
+        self.max_driver_rss = \
+            int(os.environ.get('FEELBOT_MAX_DRIVER_RSS_MB', 512)) * MB
+
+    def _acquire_slot(self, owner: str) -> Optional[str]:
+        if chrome_rss() + self.max_driver_rss > self.max_total_rss:
+            return None
+        for index in range(self.max_drivers):
+            slot = f'driver-slot:{index}'
+            if self.coordinator.acquire(slot, owner, self.SLOT_TTL):
+                return slot
+        return None
+
+    def acquire(
+        self,
+        owner: str,
+        timeout: float = 600,
+        on_wait: Optional[Callable[[], object]] = None
+    ) -> str:
+        # returns a slot while still holding the start lease, call
+        # started() once Chrome is up
+        start = time.monotonic()
+        while True:
+            if self.coordinator.acquire(self.START_LEASE, owner,
+                                        self.START_TTL):
+                slot = self._acquire_slot(owner)
+                if slot is not None:
+                    logger.debug(f'{slot}: waited '
+                                 f'{time.monotonic() - start:.3f}s')
+                    return slot
+                self.started(owner)
+            if time.monotonic() - start > timeout:
+                raise LeaseTimeoutError('driver-slot')
+            if on_wait is not None:
+                on_wait()
+            time.sleep(self.POLL_FREQUENCY)
+
+    def started(self, owner: str) -> None:
+        self.coordinator.release(self.START_LEASE, owner)
+
+    def renew(self, slot: str, owner: str) -> bool:
+        return self.coordinator.acquire(slot, owner, self.SLOT_TTL)
+
+    def record(self, slot: str, owner: str, driver: WebDriver) -> int:
+        rss = driver_rss(driver)
+        self.coordinator.set(RSS_PREFIX + owner,
+                             json.dumps({'slot': slot, 'rss': rss}))
+        return rss
+
+    def release(self, slot: str, owner: str) -> None:
+        self.coordinator.delete(RSS_PREFIX + owner)
+        self.coordinator.release(slot, owner)
+
+    def should_recycle(self, rss: int) -> bool:
+        if rss > self.max_driver_rss:
+            logger.info(f'driver uses {rss // MB} MB, recycle')
+            return True
+        return False
@@ -0,0 +1,75 @@
+import os
+import stat
+import time
+
+import pytest
+
+from feelbot.coordination import Coordinator, LeaseTimeoutError
+
+
+@pytest.fixture
+def coordinator(tmp_path):
+    return Coordinator(str(tmp_path / 'private' / 'coordination.sqlite3'))
+
+
+def test_database_is_private(coordinator):
+    mode = stat.S_IMODE(os.stat(coordinator.path).st_mode)
+    assert mode == 0o600
+    directory = os.path.dirname(coordinator.path)
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+
+
+def test_acquire_and_renew(coordinator):
+    assert coordinator.acquire('watch', 'a', 60)
+    # renewing our own lease succeeds, someone else's live lease does not
+    assert coordinator.acquire('watch', 'a', 60)
+    assert not coordinator.acquire('watch', 'b', 60)
+
+
+def test_expired_lease_is_taken_over(coordinator):
+    assert coordinator.acquire('watch', 'a', 0.05)
+    time.sleep(0.1)
+    assert coordinator.acquire('watch', 'b', 60)
+    # the previous owner cannot renew once it was taken over
+    assert not coordinator.acquire('watch', 'a', 60)
+
+
+def test_release_only_drops_own_lease(coordinator):
+    assert coordinator.acquire('watch', 'a', 60)
+    coordinator.release('watch', 'b')
+    assert not coordinator.acquire('watch', 'b', 60)
+    coordinator.release('watch', 'a')
+    assert coordinator.acquire('watch', 'b', 60)
+
+
+def test_lease_times_out_and_calls_on_wait(coordinator):
+    assert coordinator.acquire('session', 'a', 60)
+    calls = []
+    with pytest.raises(LeaseTimeoutError):
+        with coordinator.lease('session', 'b', timeout=0.3,
+                               on_wait=lambda: calls.append(1)):
+            pass
+    assert calls
+
+    coordinator.release('session', 'a')
+    with coordinator.lease('session', 'b'):
+        assert not coordinator.acquire('session', 'a', 60)
+    assert coordinator.acquire('session', 'a', 60)
+
+
+def test_cache_max_age(coordinator):
+    coordinator.set('lesson:a', 'first')
+    coordinator.set('lesson:a', 'second')
+    coordinator.set('lesson:b', 'other')
+    coordinator.set('session:a', 'cookies')
+    assert coordinator.get('lesson:a', 5) == 'second'
+    assert coordinator.get('lesson:c', 5) is None
+    assert coordinator.items('lesson:', 5) == \
+        {'a': 'second', 'b': 'other'}
+
+    time.sleep(0.1)
+    assert coordinator.get('lesson:a', 0.05) is None
+    assert coordinator.items('lesson:', 0.05) == {}
+
+    coordinator.delete('lesson:a')
+    assert coordinator.items('lesson:', 5) == {'b': 'other'}
@@ -0,0 +1,140 @@
+import json
+import threading
+
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+from feelbot.slack.dispatcher import Dispatcher
+
+
+class FakeSlack(object):
+
+    def __init__(self):
+        self.requests = []
+        self.responses = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                body = self.rfile.read(length).decode('utf-8')
+                fake.requests.append((self.path, body))
+                status, headers = \
+                    fake.responses.pop(0) if fake.responses else (200, {})
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True) \
+                 .start()
+
+    def texts(self):
+        return [json.loads(body)['text']
+                for path, body in self.requests if path == '/hook']
+
+
+@pytest.fixture
+def slack():
+    fake = FakeSlack()
+    yield fake
+    fake.server.shutdown()
+
+
+def make_dispatcher(slack, **kwargs):
+    return Dispatcher(webhook_url=slack.url + '/hook', api_url=slack.url,
+                      token='token', channel='channel',
+                      window=0.2, backoff=0.05, **kwargs)
+
+
+def test_burst_is_coalesced(slack):
+    dispatcher = make_dispatcher(slack)
+    for i in range(5):
+        dispatcher.send_message('U1', f'message {i}')
+    dispatcher.send_message('U2', 'hello')
+
+    assert dispatcher.flush(5)
+    assert sorted(slack.texts()) == [
+        '<@U1> ' + '\n\n'.join(f'message {i}' for i in range(5)),
+        '<@U2> hello',
+    ]
+    metrics = dispatcher.metrics()
+    assert metrics['delivered'] == 2
+    assert metrics['queue_depth'] == 0
+    assert metrics['latency_last'] >= 0.2
+
+
+@pytest.mark.parametrize('retry_after', ['0.1', formatdate(usegmt=True)])
+def test_rate_limit_honours_retry_after(slack, retry_after):
+    slack.responses = [(429, {'Retry-After': retry_after})]
+    dispatcher = make_dispatcher(slack)
+    dispatcher.send_message('U1', 'hello')
+
+    assert dispatcher.flush(5)
+    assert slack.texts() == ['<@U1> hello', '<@U1> hello']
+    metrics = dispatcher.metrics()
+    assert metrics['retried'] == 1
+    assert metrics['delivered'] == 1
+    assert metrics['failed'] == 0
+
+
+def test_server_error_is_retried(slack):
+    slack.responses = [(500, {}), (503, {})]
+    dispatcher = make_dispatcher(slack)
+    dispatcher.upload_file('lessons.csv', 'a,b')
+
+    assert dispatcher.flush(5)
+    assert len(slack.requests) == 3
+    assert parse_qs(slack.requests[-1][1])['title'] == ['lessons.csv']
+    metrics = dispatcher.metrics()
+    assert metrics['retried'] == 2
+    assert metrics['delivered'] == 1
+
+
+def test_queue_depth_and_overflow(slack):
+    dispatcher = make_dispatcher(slack, maxsize=2)
+    start = dispatcher._ensure_started
+    dispatcher._ensure_started = lambda: None
+    for i in range(3):
+        dispatcher.send_message('U1', f'message {i}')
+    metrics = dispatcher.metrics()
+    assert metrics['queue_depth'] == 2
+    assert metrics['dropped'] == 1
+
+    start()
+    assert dispatcher.flush(5)
+    assert slack.texts() == ['<@U1> message 0\n\nmessage 1']
+    assert dispatcher.metrics()['queue_depth'] == 0
+
+
+def test_long_retry_after_gives_up(slack):
+    slack.responses = [(429, {'Retry-After': '3600'})]
+    dispatcher = make_dispatcher(slack)
+    dispatcher.send_message('U1', 'hello')
+
+    assert dispatcher.flush(2)
+    metrics = dispatcher.metrics()
+    assert metrics['failed'] == 1
+    assert metrics['delivered'] == 0
+
+
+def test_malformed_item_does_not_block_flush(slack):
+    dispatcher = make_dispatcher(slack)
+    dispatcher._put(('message', 0.0))
+    dispatcher.send_message('U1', 'hello')
+
+    assert dispatcher.flush(5)
+    assert slack.texts() == ['<@U1> hello']
+    assert dispatcher.metrics()['failed'] == 1
@@ -0,0 +1,68 @@
+import pytest
+
+from feelbot.models import Seat, SeatPreference
+from feelbot.utils import group_positions
+
+
+def make_seats(taken=()):
+    # three rows of four seats, numbered from the front left
+    return [Seat(number=number,
+                 available=number not in taken,
+                 row=(number - 1) // 4,
+                 column=(number - 1) % 4)
+            for number in range(1, 13)]
+
+
+def test_choose_defaults_to_last_listed_seat():
+    assert SeatPreference().choose(make_seats()).number == 12
+    assert SeatPreference().choose(make_seats(taken=[12])).number == 11
+
+
+def test_choose_prefers_favorites_in_order():
+    preference = SeatPreference(favorites=[6, 2], front_row=True)
+    assert preference.choose(make_seats()).number == 6
+    assert preference.choose(make_seats(taken=[6])).number == 2
+    # no favorite left, fall back to the front row
+    assert preference.choose(make_seats(taken=[6, 2])).number == 4
+
+
+def test_choose_front_row_then_last_listed():
+    preference = SeatPreference(front_row=True)
+    assert preference.choose(make_seats()).number == 4
+    assert preference.choose(make_seats(taken=[1, 2, 3, 4])).number == 8
+
+
+def test_choose_skips_avoided_and_taken_seats():
+    preference = SeatPreference(favorites=[12], avoid=[12, 11])
+    assert preference.choose(make_seats(taken=[10])).number == 9
+    assert SeatPreference().choose(make_seats(taken=range(1, 13))) is None
+
+
+def test_group_positions_tolerates_small_offsets():
+    assert group_positions([10, 11, 10.5, 50, 49, 90], 5) == \
+        [0, 0, 0, 1, 1, 2]
+
+
+def test_group_positions_does_not_chain_groups():
+    assert group_positions([10, 14, 18, 22], 5) == [0, 0, 1, 1]
+
+
+def test_read_seat_map_builds_grid():
+    client = pytest.importorskip('feelbot.client')
+
+    class FakeDriver(object):
+        def execute_script(self, script):
+            return [
+                {'text': ' 1 ', 'link': 'a1', 'linkClass': 'thickbox',
+                 'top': 100, 'left': 10, 'height': 20, 'width': 20},
+                {'text': '2', 'link': 'a2', 'linkClass': 'reserved',
+                 'top': 101, 'left': 40, 'height': 20, 'width': 20},
+                {'text': '3', 'link': 'a3', 'linkClass': '',
+                 'top': 140, 'left': 11, 'height': 20, 'width': 20},
+            ]
+
+    seats, links = client.read_seat_map(FakeDriver())
+    assert [(seat.number, seat.available, seat.row, seat.column)
+            for seat in seats] == \
+        [(1, True, 0, 0), (2, False, 0, 1), (3, True, 1, 0)]
+    assert links == {1: 'a1', 2: 'a2', 3: 'a3'}